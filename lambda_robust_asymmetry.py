@@ -1,6 +1,13 @@
 import json
-import math
 import logging
+from bisect import bisect_right
+from math import sqrt
+
+try:
+    # orjson is optional (e.g. provided by a Lambda layer); parses large batch bodies faster
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -12,69 +19,127 @@ NIHSS_2_MODERATE = 0.50        # 35-50% - Moderate drift
 NIHSS_3_SEVERE = 0.70          # 50-70% - Severe drift
 NIHSS_4_PARALYSIS = 0.70       # >70% - Critical
 
+# Keypoint detection quality thresholds (average arm length / left-right arm length difference)
+QUALITY_VERY_SMALL_ARM = 0.02  # Average arm length below this - very poor
+QUALITY_SMALL_ARM = 0.05       # Average arm length below this - poor
+QUALITY_DIFF_VERY_POOR = 0.8   # >80% arm length difference - very poor
+QUALITY_DIFF_POOR = 0.5        # >50% arm length difference - poor
+QUALITY_DIFF_FAIR = 0.3        # >30% arm length difference - fair
+
+# Integer detection quality codes carried in the assessment as 'code' (lower = worse)
+QUALITY_CODE_VERY_POOR = 0
+QUALITY_CODE_POOR = 1
+QUALITY_CODE_FAIR = 2
+QUALITY_CODE_GOOD = 3
+
+# Headers for every response; each response gets its own copy so callers cannot alter the shared dict
+RESPONSE_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+
+# Lower bounds of NIHSS motor scores 1-4; score = number of bounds <= drift
+_NIHSS_EDGES = (NIHSS_0_NORMAL, NIHSS_1_MILD, NIHSS_2_MODERATE, NIHSS_3_SEVERE)
+
+# Prebuilt result for each NIHSS motor score (index = score); callers receive a copy
+_NIHSS_RESULTS = (
+    {'nihss_motor_score': 0, 'severity': 'normal', 'clinical_interpretation': 'No significant drift detected. Arms held steady within normal variation range.'},
+    {'nihss_motor_score': 1, 'severity': 'mild', 'clinical_interpretation': 'Mild arm variation detected. Arms show slight positioning differences but remain functional.'},
+    {'nihss_motor_score': 2, 'severity': 'moderate', 'clinical_interpretation': 'Moderate arm variation detected. Arms show noticeable positioning differences but maintain some control.'},
+    {'nihss_motor_score': 3, 'severity': 'severe', 'clinical_interpretation': 'Severe arm variation detected. Arms show significant positioning differences with limited control.'},
+    {'nihss_motor_score': 4, 'severity': 'critical', 'clinical_interpretation': 'Critical arm variation detected. Arms show severe positioning differences or inability to maintain position.'},
+)
+
+def _normalize_drift(y_difference):
+    """Convert a drift given in percent (> 1.0) to a fraction; fractions pass through unchanged."""
+    return y_difference / 100.0 if y_difference > 1.0 else y_difference
+
+# (score, severity) pair for each NIHSS motor score; immutable, so batch results can share them
+_NIHSS_SCORE_SEVERITY = tuple((r['nihss_motor_score'], r['severity']) for r in _NIHSS_RESULTS)
+
+def calculate_nihss_batch_scores(y_differences):
+    """Score a sequence of drift values (e.g. a window of frames); returns a list of (score, severity) pairs.
+    
+    Matches calculate_nihss_motor_score value for value:
+    
+    >>> drifts = [0.19, 0.2, 0.35, 0.69, 0.7, 45.0]
+    >>> calculate_nihss_batch_scores(drifts)
+    [(0, 'normal'), (1, 'mild'), (2, 'moderate'), (3, 'severe'), (4, 'critical'), (2, 'moderate')]
+    >>> expected = [calculate_nihss_motor_score(y) for y in drifts + [0.0, 150.0]]
+    >>> calculate_nihss_batch_scores(drifts + [0.0, 150.0]) == [(r['nihss_motor_score'], r['severity']) for r in expected]
+    True
+    """
+    return [_NIHSS_SCORE_SEVERITY[bisect_right(_NIHSS_EDGES, _normalize_drift(y))] for y in y_differences]
+
 def calculate_nihss_motor_score(y_difference, test_duration=20.0):
     """Calculate NIHSS Motor Arm Score with realistic thresholds."""
-    if y_difference > 1.0:
-        y_difference = y_difference / 100.0
-    
-    if y_difference < NIHSS_0_NORMAL:
-        return {'nihss_motor_score': 0, 'severity': 'normal', 'clinical_interpretation': 'No significant drift detected. Arms held steady within normal variation range.'}
-    elif y_difference < NIHSS_1_MILD:
-        return {'nihss_motor_score': 1, 'severity': 'mild', 'clinical_interpretation': 'Mild arm variation detected. Arms show slight positioning differences but remain functional.'}
-    elif y_difference < NIHSS_2_MODERATE:
-        return {'nihss_motor_score': 2, 'severity': 'moderate', 'clinical_interpretation': 'Moderate arm variation detected. Arms show noticeable positioning differences but maintain some control.'}
-    elif y_difference < NIHSS_3_SEVERE:
-        return {'nihss_motor_score': 3, 'severity': 'severe', 'clinical_interpretation': 'Severe arm variation detected. Arms show significant positioning differences with limited control.'}
-    else:
-        return {'nihss_motor_score': 4, 'severity': 'critical', 'clinical_interpretation': 'Critical arm variation detected. Arms show severe positioning differences or inability to maintain position.'}
+    return _NIHSS_RESULTS[bisect_right(_NIHSS_EDGES, _normalize_drift(y_difference))].copy()
+
+# Keypoints used for the arm analysis, in the order they are packed into flat coordinates
+ARM_KEYPOINTS = ('left_wrist', 'right_wrist', 'left_shoulder', 'right_shoulder')
+
+def pack_arm_keypoints(keypoints):
+    """Flatten arm keypoints into (lwx, lwy, rwx, rwy, lsx, lsy, rsx, rsy), or None if any keypoint or coordinate is missing."""
+    coords = []
+    for name in ARM_KEYPOINTS:
+        kp = keypoints.get(name, {})
+        x = kp.get('x')
+        y = kp.get('y')
+        if x is None or y is None:
+            return None
+        coords.append(x)
+        coords.append(y)
+    return tuple(coords)
+
+def arm_lengths(coords):
+    """Return (left_arm_length, right_arm_length) from packed wrist/shoulder coordinates."""
+    lwx, lwy, rwx, rwy, lsx, lsy, rsx, rsy = coords
+    left_arm_length = sqrt((lwx - lsx)**2 + (lwy - lsy)**2)
+    right_arm_length = sqrt((rwx - rsx)**2 + (rwy - rsy)**2)
+    return left_arm_length, right_arm_length
 
 def assess_keypoint_detection_quality(keypoints):
     """Assess the quality of keypoint detection to choose the best asymmetry calculation method."""
     
-    # Extract coordinates
-    left_wrist = keypoints.get('left_wrist', {})
-    right_wrist = keypoints.get('right_wrist', {})
-    left_shoulder = keypoints.get('left_shoulder', {})
-    right_shoulder = keypoints.get('right_shoulder', {})
-    
-    # Check if we have all required keypoints
-    required_keypoints = [left_wrist, right_wrist, left_shoulder, right_shoulder]
-    if not all(kp.get('x') is not None and kp.get('y') is not None for kp in required_keypoints):
-        return {'quality': 'poor', 'reason': 'Missing required keypoints'}
+    # Pack coordinates once; None means a required keypoint is missing
+    coords = pack_arm_keypoints(keypoints)
+    if coords is None:
+        return {'code': QUALITY_CODE_POOR, 'quality': 'poor', 'reason': 'Missing required keypoints', 'coords': None}
     
     # Calculate arm lengths
-    left_arm_length = math.sqrt((left_wrist['x'] - left_shoulder['x'])**2 + 
-                               (left_wrist['y'] - left_shoulder['y'])**2)
-    right_arm_length = math.sqrt((right_wrist['x'] - right_shoulder['x'])**2 + 
-                                (right_wrist['y'] - right_shoulder['y'])**2)
+    left_arm_length, right_arm_length = arm_lengths(coords)
     avg_arm_length = (left_arm_length + right_arm_length) / 2
     
     # Quality indicators
     arm_length_diff = abs(left_arm_length - right_arm_length) / max(left_arm_length, right_arm_length) if max(left_arm_length, right_arm_length) > 0 else 1.0
-    small_arm_lengths = avg_arm_length < 0.05
-    very_small_arm_lengths = avg_arm_length < 0.02
     
     # Determine quality
-    if very_small_arm_lengths or arm_length_diff > 0.8:
+    if avg_arm_length < QUALITY_VERY_SMALL_ARM or arm_length_diff > QUALITY_DIFF_VERY_POOR:
+        code = QUALITY_CODE_VERY_POOR
         quality = 'very_poor'
         reason = f'Very small arm lengths ({avg_arm_length:.3f}) or large difference ({arm_length_diff:.1%})'
-    elif small_arm_lengths or arm_length_diff > 0.5:
+    elif avg_arm_length < QUALITY_SMALL_ARM or arm_length_diff > QUALITY_DIFF_POOR:
+        code = QUALITY_CODE_POOR
         quality = 'poor'
         reason = f'Small arm lengths ({avg_arm_length:.3f}) or significant difference ({arm_length_diff:.1%})'
-    elif arm_length_diff > 0.3:
+    elif arm_length_diff > QUALITY_DIFF_FAIR:
+        code = QUALITY_CODE_FAIR
         quality = 'fair'
         reason = f'Moderate arm length difference ({arm_length_diff:.1%})'
     else:
+        code = QUALITY_CODE_GOOD
         quality = 'good'
         reason = f'Good arm length consistency ({arm_length_diff:.1%})'
     
     return {
+        'code': code,
         'quality': quality,
         'reason': reason,
         'arm_length_diff': arm_length_diff,
         'avg_arm_length': avg_arm_length,
         'left_arm_length': left_arm_length,
-        'right_arm_length': right_arm_length
+        'right_arm_length': right_arm_length,
+        'coords': coords
     }
 
 def calculate_robust_asymmetry(keypoints):
@@ -83,7 +148,7 @@ def calculate_robust_asymmetry(keypoints):
     # Assess detection quality
     quality_assessment = assess_keypoint_detection_quality(keypoints)
     
-    if quality_assessment['quality'] == 'very_poor':
+    if quality_assessment['code'] == QUALITY_CODE_VERY_POOR:
         return {
             'asymmetry_score': 0.0,
             'asymmetry_percent': 0.0,
@@ -93,35 +158,38 @@ def calculate_robust_asymmetry(keypoints):
             'error': 'Very poor keypoint detection quality - cannot assess asymmetry'
         }
     
-    # Extract coordinates
-    left_wrist = keypoints['left_wrist']
-    right_wrist = keypoints['right_wrist']
-    left_shoulder = keypoints['left_shoulder']
-    right_shoulder = keypoints['right_shoulder']
+    # Packed (lwx, lwy, rwx, rwy, ...) coordinates; None when any wrist or shoulder keypoint,
+    # or its x or y coordinate, is missing - reported as an error (400) rather than scored
+    coords = quality_assessment['coords']
+    if coords is None:
+        return {
+            'asymmetry_score': 0.0,
+            'asymmetry_percent': 0.0,
+            'drift_detected': False,
+            'method_used': 'fallback',
+            'quality_assessment': quality_assessment,
+            'error': quality_assessment['reason']
+        }
     
-    # Calculate vertical drift
-    vertical_drift = abs(left_wrist['y'] - right_wrist['y'])
+    # Calculate vertical drift (left wrist y vs right wrist y)
+    vertical_drift = abs(coords[1] - coords[3])
     
     # Choose calculation method based on quality
-    if quality_assessment['quality'] in ['poor', 'very_poor']:
+    if quality_assessment['code'] <= QUALITY_CODE_POOR:
         # Use absolute vertical drift for poor detection quality
         asymmetry_score = vertical_drift
         method_used = 'absolute_vertical_drift'
-        print(f"DEBUG: Using absolute vertical drift method due to poor detection quality: {quality_assessment['reason']}")
+        logger.debug("Using absolute vertical drift method due to poor detection quality: %s", quality_assessment['reason'])
     else:
-        # Use normalized method for good detection quality
-        left_arm_length = math.sqrt((left_wrist['x'] - left_shoulder['x'])**2 + 
-                                   (left_wrist['y'] - left_shoulder['y'])**2)
-        right_arm_length = math.sqrt((right_wrist['x'] - right_shoulder['x'])**2 + 
-                                    (right_wrist['y'] - right_shoulder['y'])**2)
-        avg_arm_length = (left_arm_length + right_arm_length) / 2
+        # Use normalized method for good detection quality (arm lengths already computed by the assessment)
+        avg_arm_length = quality_assessment['avg_arm_length']
         
         if avg_arm_length > 0.01:
             asymmetry_score = vertical_drift / avg_arm_length
         else:
             asymmetry_score = vertical_drift  # Fallback to absolute
         method_used = 'normalized_vertical_drift'
-        print(f"DEBUG: Using normalized vertical drift method due to good detection quality")
+        logger.debug("Using normalized vertical drift method due to good detection quality")
     
     # Calculate NIHSS score
     nihss_result = calculate_nihss_motor_score(asymmetry_score)
@@ -143,101 +211,142 @@ def calculate_robust_asymmetry(keypoints):
         'error': None
     }
 
+def error_body(message):
+    """Response body for a request or scenario that could not be analyzed."""
+    return {
+        'error': message,
+        'drift_detected': False,
+        'asymmetry_score': 0.0,
+        'nihss_motor_score': 0
+    }
+
+def analyze_scenario(body):
+    """Analyze a single keypoint payload and return (status_code, response_body)."""
+    
+    # Extract keypoint data from iOS app
+    keypoints = body.get('keypoints', {})
+    user_id = body.get('user_id', 'unknown')
+    test_mode = body.get('test_mode', False)
+    force_drift = body.get('force_drift', False)
+    user_intentionally_drifting = body.get('user_intentionally_drifting', False)
+    
+    print(f"DEBUG: User ID: {user_id}")
+    print(f"DEBUG: Test mode: {test_mode}, Force drift: {force_drift}")
+    print(f"DEBUG: User intentionally drifting: {user_intentionally_drifting}")
+    print(f"DEBUG: Keypoints received: {list(keypoints.keys())}")
+    
+    # Analyze keypoint asymmetry with robust method
+    analysis_result = calculate_robust_asymmetry(keypoints)
+    
+    if analysis_result.get('error'):
+        print(f"DEBUG: Analysis error: {analysis_result['error']}")
+        return 400, error_body(analysis_result['error'])
+    
+    # Handle test modes
+    if force_drift:
+        analysis_result['drift_detected'] = True
+        analysis_result['asymmetry_score'] = 0.08  # Force significant drift
+        analysis_result['nihss_motor_score'] = 3
+        analysis_result['severity'] = 'severe'
+        analysis_result['clinical_interpretation'] = 'FORCED DRIFT for testing purposes'
+        print(f"DEBUG: FORCED DRIFT for testing")
+    
+    # Return comprehensive clinical assessment
+    return 200, {
+        'drift_detected': analysis_result['drift_detected'],
+        'asymmetry_score': analysis_result['asymmetry_score'],
+        'asymmetry_percent': analysis_result['asymmetry_percent'],
+        'y_difference': analysis_result['asymmetry_score'],  # Legacy field
+        'clinical_score': analysis_result['nihss_motor_score'],  # Legacy field
+        'nihss_motor_score': analysis_result['nihss_motor_score'],
+        'nihss_total': analysis_result['nihss_total'],
+        'severity': analysis_result['severity'],
+        'message': analysis_result['clinical_interpretation'],
+        'clinical_interpretation': analysis_result['clinical_interpretation'],
+        'test_quality': 'robust_keypoint_analysis',
+        'research_based': True,
+        'clinical_standards': 'NIHSS_Motor_Arm_Item5_Robust',
+        'analysis_method': analysis_result['method_used'],
+        'detection_quality': analysis_result['quality_assessment']['quality'],
+        'quality_reason': analysis_result['quality_assessment']['reason'],
+        'vertical_drift': analysis_result['vertical_drift']
+    }
+
+def extract_body(event):
+    """Return the request payload for API Gateway (JSON string body) or direct invocation events."""
+    if 'body' not in event:
+        return event
+    body = event['body']
+    if isinstance(body, str):
+        return json_loads(body)
+    return body
+
 def lambda_handler(event, context):
+    """Handle a single scenario, or a {"batch": [...]} of scenarios answered as {"results": [...]}.
+    
+    Each batch result carries its own status_code; the batch itself is answered with 200:
+    
+    >>> import contextlib, io
+    >>> arm = {'left_wrist': {'x': 0.1, 'y': 0.5}, 'right_wrist': {'x': 0.9, 'y': 0.7},
+    ...        'left_shoulder': {'x': 0.3, 'y': 0.5}, 'right_shoulder': {'x': 0.7, 'y': 0.5}}
+    >>> batch = [{'keypoints': arm}, {'keypoints': {'left_wrist': arm['left_wrist']}}, 5]
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     response = lambda_handler({'body': json.dumps({'batch': batch})}, None)
+    >>> response['statusCode']
+    200
+    >>> [(r['status_code'], r.get('error')) for r in json.loads(response['body'])['results']]
+    [(200, None), (400, 'Missing required keypoints'), (400, "Each batch scenario must be an object with a 'keypoints' object")]
+    >>> lambda_handler({'batch': {'keypoints': arm}}, None)['statusCode']
+    400
+    """
     try:
-        # Debug: Log the incoming event structure
-        print(f"DEBUG: Event received: {json.dumps(event, indent=2)}")
+        # Debug: Log the incoming event structure (only serialized when DEBUG logging is on)
+        logger.debug("Event received: %s", event)
         
-        # Handle different event formats
-        body = None
-        if 'body' in event:
-            if isinstance(event['body'], str):
-                body = json.loads(event['body'])
-            else:
-                body = event['body']
-        else:
-            body = event
-        
-        # Extract keypoint data from iOS app
-        keypoints = body.get('keypoints', {})
-        user_id = body.get('user_id', 'unknown')
-        test_mode = body.get('test_mode', False)
-        force_drift = body.get('force_drift', False)
-        user_intentionally_drifting = body.get('user_intentionally_drifting', False)
-        
-        print(f"DEBUG: User ID: {user_id}")
-        print(f"DEBUG: Test mode: {test_mode}, Force drift: {force_drift}")
-        print(f"DEBUG: User intentionally drifting: {user_intentionally_drifting}")
-        print(f"DEBUG: Keypoints received: {list(keypoints.keys())}")
+        body = extract_body(event)
         
-        # Analyze keypoint asymmetry with robust method
-        analysis_result = calculate_robust_asymmetry(keypoints)
-        
-        if analysis_result.get('error'):
-            print(f"DEBUG: Analysis error: {analysis_result['error']}")
+        # Batched scenarios: {"batch": [scenario, ...]} -> {"results": [...]}
+        batch = body.get('batch')
+        if batch is not None:
+            if not isinstance(batch, list):
+                return {
+                    'statusCode': 400,
+                    'headers': dict(RESPONSE_HEADERS),
+                    'body': json.dumps(error_body("'batch' must be a list of scenarios"))
+                }
+            
+            results = []
+            for scenario in batch:
+                # Malformed elements are client errors (400); an exception while analyzing a
+                # well-formed scenario gets its own 500 entry instead of failing the whole batch
+                if not isinstance(scenario, dict) or not isinstance(scenario.get('keypoints', {}), dict):
+                    status_code, result = 400, error_body("Each batch scenario must be an object with a 'keypoints' object")
+                else:
+                    try:
+                        status_code, result = analyze_scenario(scenario)
+                    except Exception as e:
+                        logger.error(f"Error processing batch scenario: {e}")
+                        status_code, result = 500, error_body(str(e))
+                result['status_code'] = status_code
+                results.append(result)
+            logger.debug("Batch of %d scenarios analyzed", len(results))
             return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': analysis_result['error'],
-                    'drift_detected': False,
-                    'asymmetry_score': 0.0,
-                    'nihss_motor_score': 0
-                })
+                'statusCode': 200,
+                'headers': dict(RESPONSE_HEADERS),
+                'body': json.dumps({'results': results})
             }
         
-        # Handle test modes
-        if force_drift:
-            analysis_result['drift_detected'] = True
-            analysis_result['asymmetry_score'] = 0.08  # Force significant drift
-            analysis_result['nihss_motor_score'] = 3
-            analysis_result['severity'] = 'severe'
-            analysis_result['clinical_interpretation'] = 'FORCED DRIFT for testing purposes'
-            print(f"DEBUG: FORCED DRIFT for testing")
-        
-        # Return comprehensive clinical assessment
+        status_code, result = analyze_scenario(body)
         return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'drift_detected': analysis_result['drift_detected'],
-                'asymmetry_score': analysis_result['asymmetry_score'],
-                'asymmetry_percent': analysis_result['asymmetry_percent'],
-                'y_difference': analysis_result['asymmetry_score'],  # Legacy field
-                'clinical_score': analysis_result['nihss_motor_score'],  # Legacy field
-                'nihss_motor_score': analysis_result['nihss_motor_score'],
-                'nihss_total': analysis_result['nihss_total'],
-                'severity': analysis_result['severity'],
-                'message': analysis_result['clinical_interpretation'],
-                'clinical_interpretation': analysis_result['clinical_interpretation'],
-                'test_quality': 'robust_keypoint_analysis',
-                'research_based': True,
-                'clinical_standards': 'NIHSS_Motor_Arm_Item5_Robust',
-                'analysis_method': analysis_result['method_used'],
-                'detection_quality': analysis_result['quality_assessment']['quality'],
-                'quality_reason': analysis_result['quality_assessment']['reason'],
-                'vertical_drift': analysis_result['vertical_drift']
-            })
+            'statusCode': status_code,
+            'headers': dict(RESPONSE_HEADERS),
+            'body': json.dumps(result)
         }
         
     except Exception as e:
         logger.error(f"Error processing request: {e}")
         return {
             'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': str(e),
-                'drift_detected': False,
-                'asymmetry_score': 0.0,
-                'nihss_motor_score': 0
-            })
+            'headers': dict(RESPONSE_HEADERS),
+            'body': json.dumps(error_body(str(e)))
         }